@@ -0,0 +1,125 @@
+# storage.py
+# Year-partitioned Parquet datasets shared by the update scripts. Daily runs
+# only append their new rows; a marker file next to each dataset holds the
+# newest stored date so the start date is known without opening the data.
+import glob
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def last_date_file(path):
+    return path + ".last_date.txt"
+
+
+def recover(path):
+    # finish or roll back a compaction that was killed part-way (see compact)
+    old_dir, tmp_dir = path + ".old", path + ".tmp"
+    if os.path.exists(old_dir):
+        if os.path.exists(path):
+            # killed after the new copy was in place: only the cleanup is left
+            shutil.rmtree(old_dir)
+        else:
+            # killed between the two renames: put the previous copy back
+            os.rename(old_dir, path)
+    if os.path.exists(tmp_dir) and os.path.exists(path):
+        # an unfinished rewrite; the live copy is intact
+        shutil.rmtree(tmp_dir)
+
+
+def read_last_date(path, date_col):
+    recover(path)
+    marker = last_date_file(path)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            return pd.Timestamp(f.read().strip())
+    if os.path.exists(path):
+        # marker lost (e.g. run interrupted before writing it): rebuild from the date column only
+        dates = pd.read_parquet(path, columns=[date_col])[date_col]
+        if not dates.empty:
+            return pd.Timestamp(dates.max())
+    return None
+
+
+def write_last_date(path, last_date):
+    with open(last_date_file(path), "w") as f:
+        f.write(pd.Timestamp(last_date).isoformat())
+
+
+def migrate_csv(csv_path, path, date_col, value_cols):
+    # one-off import of the CSV history written before the switch to Parquet,
+    # so the first run after upgrading resumes instead of re-downloading it all
+    recover(path)
+    if os.path.exists(path) or os.path.exists(last_date_file(path)) or not os.path.exists(csv_path):
+        return False
+    df = pd.read_csv(csv_path)
+    if df.empty:
+        return False
+    df[date_col] = pd.to_datetime(df[date_col], format="ISO8601")
+    df.drop_duplicates(subset=[date_col], keep="last", inplace=True)
+    df.sort_values(date_col, inplace=True)
+    write_parquet(df, path, date_col, value_cols)
+    write_last_date(path, df[date_col].max())
+    return True
+
+
+def read_dataset(path):
+    # files are read in write order (see write_parquet), so keep="first"/"last"
+    # on duplicate dates means the oldest/newest write
+    files = sorted(glob.glob(os.path.join(path, "year=*", "*.parquet")), key=os.path.basename)
+    if not files:
+        return pd.DataFrame()
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+
+
+def write_parquet(df, path, date_col, value_cols):
+    # every appended file gets the same schema: a column that is all None in one
+    # batch would otherwise be stored as Arrow null, which pyarrow cannot unify
+    # with the float64 files written by other runs
+    out = pd.DataFrame({date_col: pd.to_datetime(df[date_col]).astype("datetime64[ns]")})
+    for col in value_cols:
+        if col in df.columns:
+            out[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+        else:
+            out[col] = np.nan
+    if "source" in df.columns:
+        out["source"] = df["source"].astype("category")
+    out["year"] = out[date_col].dt.year
+    # nanosecond timestamp prefix makes file names sort in write order
+    out.to_parquet(path, engine="pyarrow", compression="zstd", index=False,
+                   partition_cols=["year"],
+                   basename_template=f"{time.time_ns():020d}-{{i}}.parquet")
+
+
+def stored_dates(path, date_col, years):
+    # only the partitions the new rows fall into can hold overlapping dates
+    if not os.path.exists(path):
+        return pd.Series([], dtype="datetime64[ns]")
+    return pd.read_parquet(path, columns=[date_col],
+                           filters=[("year", "in", years)])[date_col]
+
+
+def compact(path, date_col, value_cols, keep="last"):
+    # appends leave many small files, and an interrupted run can leave repeated
+    # dates; rewrite the dataset sorted and de-duplicated. Returns the row count.
+    recover(path)
+    if not os.path.exists(path):
+        return None
+    df_all = read_dataset(path)
+    if df_all.empty:
+        return 0
+    df_all.drop_duplicates(subset=[date_col], keep=keep, inplace=True)
+    df_all.sort_values(date_col, inplace=True)
+
+    # swap by renames so a copy of the history exists at every point;
+    # recover() completes or undoes the swap if the process dies in between
+    tmp_dir, old_dir = path + ".tmp", path + ".old"
+    write_parquet(df_all, tmp_dir, date_col, value_cols)
+    os.rename(path, old_dir)
+    os.rename(tmp_dir, path)
+    shutil.rmtree(old_dir)
+    write_last_date(path, df_all[date_col].max())
+    return len(df_all)
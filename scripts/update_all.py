@@ -1,26 +1,106 @@
-import subprocess
+import contextvars
+import importlib
+import io
+import logging
 import os
 import sys
+import traceback
 import datetime # <-- New import for time logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Path to scripts folder (relative to this file)
 SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPTS_DIR)
 
-# List of update scripts
+# List of update scripts, run in-process so they share one interpreter and
+# one copy of pandas/xarray instead of each paying the import cost
 scripts = [
-    "update_era5.py",
-    "update_nasa.py",
-    "update_openmeteo.py"
+    "update_era5",
+    "update_nasa",
+    "update_openmeteo"
 ]
 
-def run_script(script_name):
-    script_path = os.path.join(SCRIPTS_DIR, script_name)
-    print(f"\n Running {script_name} ...")
+# Updates only append; once a week each dataset is de-duplicated and rewritten
+COMPACT_WEEKDAY = 6  # Sunday
+
+
+# Buffer of the script whose code is currently running. Context variables
+# follow asyncio tasks, and threads a script starts itself run their tasks in
+# a copy of its context (see update_era5.fetch_range).
+script_output = contextvars.ContextVar("script_output", default=None)
+
+
+class ScriptOutputRouter(io.TextIOBase):
+    # Stands in for sys.stdout and sys.stderr while the scripts run, so each
+    # script's prints, warnings and log lines are collected in its own buffer
+    # (stderr merged into stdout) and concurrent runs don't interleave
+    def __init__(self, stream):
+        self.stream = stream
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, "encoding", "utf-8")
+
+    @property
+    def errors(self):
+        return getattr(self.stream, "errors", "strict")
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        (script_output.get() or self.stream).write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        # buffered script output is not a terminal (keeps progress bars plain)
+        return script_output.get() is None and self.stream.isatty()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+
+def load_modules():
+    modules = {}
+    for name in scripts:
+        try:
+            modules[name] = importlib.import_module(name)
+        except Exception as e:
+            print(f" {name} could not be imported: {e}")
+    return modules
+
+
+def run_script(module, func_name):
+    buf = io.StringIO()
+    token = script_output.set(buf)
     try:
-        subprocess.run([sys.executable, script_path], check=True)
-        print(f" {script_name} completed successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f" {script_name} failed with error: {e}")
+        getattr(module, func_name)()
+        ok = True
+    except Exception:
+        traceback.print_exc(file=buf)
+        ok = False
+    finally:
+        script_output.reset(token)
+    return ok, buf.getvalue()
+
+
+def run_all(modules, func_name):
+    # All scripts are I/O-bound and independent, so run them side by side
+    with ThreadPoolExecutor(max_workers=len(modules)) as pool:
+        futures = {pool.submit(run_script, module, func_name): name
+                   for name, module in modules.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            print(f"\n Output of {name}.{func_name}():")
+            ok, output = future.result()
+            print(output, end="")
+            if ok:
+                print(f" {name} completed successfully.")
+            else:
+                print(f" {name} failed.")
 
 
 def main():
@@ -30,8 +110,24 @@ def main():
     print(f"✅ RUN STARTED: {current_time}")
     print(f"==========================================================")
     
-    for script in scripts:
-        run_script(script)
+    modules = load_modules()
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ScriptOutputRouter(real_stdout), ScriptOutputRouter(real_stderr)
+    # handlers set up at import time (e.g. cdsapi's logging) hold the real streams
+    rerouted = []
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream in (real_stdout, real_stderr):
+            router = sys.stderr if handler.stream is real_stderr else sys.stdout
+            rerouted.append((handler, handler.setStream(router)))
+    try:
+        if modules:
+            run_all(modules, "main")
+            if datetime.date.today().weekday() == COMPACT_WEEKDAY:
+                run_all(modules, "compact")
+    finally:
+        for handler, stream in rerouted:
+            handler.setStream(stream)
+        sys.stdout, sys.stderr = real_stdout, real_stderr
 
     # --- FINISH LOGGING ---
     finish_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -40,4 +136,4 @@ def main():
     print(f"==========================================================")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
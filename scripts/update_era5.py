@@ -1,19 +1,31 @@
 # update_era5.py
+import contextvars
+import io
 import os
 import tarfile
 import zipfile
 import shutil
+import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from types import MappingProxyType
 from datetime import date, timedelta
+from typing import Optional
 
 import numpy as np
 import pandas as pd
 import xarray as xr
 import cdsapi
 
+import storage
+
 # always save into Smart_Produce/data/
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-CSV_FILE = os.path.join(BASE_DIR, "data", "era5_data.csv")
+# year-partitioned Parquet dataset, so daily updates only rewrite the current year
+PARQUET_DIR = os.path.join(BASE_DIR, "data", "era5_data.parquet")
+# pre-Parquet history, imported once on the first run after upgrading
+LEGACY_CSV_FILE = os.path.join(BASE_DIR, "data", "era5_data.csv")
 
 PARAMS = [
     "2m_temperature",
@@ -29,6 +41,28 @@ PARAMS = [
 LAT, LON = 38.57, -7.91
 AREA = [LAT + 0.1, LON - 0.1, LAT - 0.1, LON + 0.1]
 
+# one day of hourly steps per dask chunk; ERA5 files use either time name
+NC_CHUNKS = {"time": 24, "valid_time": 24}
+
+# CDS long names and NetCDF short names → output column names
+VAR_RENAME = MappingProxyType({
+    "2m_temperature": "temperature",
+    "2m_dewpoint_temperature": "dewpoint",
+    "surface_pressure": "pressure",
+    "10m_u_component_of_wind": "u_wind",
+    "10m_v_component_of_wind": "v_wind",
+    "total_precipitation": "precipitation",
+    "surface_solar_radiation_downwards": "radiation",
+
+    "t2m": "temperature",
+    "d2m": "dewpoint",
+    "sp": "pressure",
+    "u10": "u_wind",
+    "v10": "v_wind",
+    "tp": "precipitation",
+    "ssrd": "radiation",
+})
+
 DAILY_AGG = {
     "temperature": "mean",
     "dewpoint": "mean",
@@ -38,6 +72,17 @@ DAILY_AGG = {
     "radiation": "sum",
 }
 
+# columns stored in the dataset besides date and source
+VALUE_COLS = list(DAILY_AGG)
+
+# unit conversion as value * scale + offset: K→°C, Pa→kPa, m→mm, J/m²→MJ/m²
+UNIT_COLS = ["temperature", "dewpoint", "pressure", "wind_speed", "precipitation", "radiation"]
+UNIT_SCALE = np.array([1.0, 1.0, 1e-3, 1.0, 1e3, 1e-6])
+UNIT_OFFSET = np.array([-273.15, -273.15, 0.0, 0.0, 0.0, 0.0])
+
+# CDS throttles per user, more parallel requests just queue up server-side
+MAX_CDS_WORKERS = 4
+
 c = cdsapi.Client()
 
 def _log_head(path, max_bytes=400):
@@ -48,69 +93,77 @@ def _log_head(path, max_bytes=400):
     except Exception as e:
         print(f"[DEBUG] Could not read head of file {path}: {e}")
 
+def _open_netcdf_bytes(buf):
+    # netCDF4/HDF5 via h5netcdf, classic netCDF3 via scipy; both accept file-like objects
+    last_err = None
+    for eng in ("h5netcdf", "scipy"):
+        try:
+            return xr.open_dataset(io.BytesIO(buf), engine=eng, chunks=NC_CHUNKS, decode_cf=True)
+        except Exception as e:
+            last_err = e
+            print(f"[DEBUG] xarray engine '{eng}' failed on in-memory file: {e}")
+    raise ValueError(f"Could not open NetCDF: {last_err}")
+
+def _open_netcdf_members(bufs):
+    # CDS puts instant and accumulated variables in separate files
+    # (stepType-instant / stepType-accum); combine them into one dataset
+    datasets = [_open_netcdf_bytes(buf) for buf in bufs]
+    if len(datasets) == 1:
+        return datasets[0]
+    return xr.merge(datasets, compat="override", join="outer")
+
 def _open_any_netcdf(path):
+    # archives are read straight into memory instead of being extracted to disk
     if tarfile.is_tarfile(path):
-        with tarfile.open(path) as tf, tempfile.TemporaryDirectory() as tdir:
+        with tarfile.open(path) as tf:
             members = [m for m in tf.getmembers() if m.name.lower().endswith(".nc")]
             if not members:
                 _log_head(path)
                 raise ValueError("Downloaded TAR has no .nc inside.")
-            tf.extract(members[0], path=tdir)
-            return _open_any_netcdf(os.path.join(tdir, members[0].name))
+            bufs = [tf.extractfile(m).read() for m in members]
+        return _open_netcdf_members(bufs)
     
     if zipfile.is_zipfile(path):
-        with zipfile.ZipFile(path) as zf, tempfile.TemporaryDirectory() as tdir:
+        with zipfile.ZipFile(path) as zf:
             nc_members = [n for n in zf.namelist() if n.lower().endswith(".nc")]
             if not nc_members:
                 _log_head(path)
                 raise ValueError("Downloaded ZIP has no .nc inside.")
-            zf.extract(nc_members[0], path=tdir)
-            return _open_any_netcdf(os.path.join(tdir, nc_members[0]))
+            bufs = [zf.read(n) for n in nc_members]
+        return _open_netcdf_members(bufs)
     
     last_err = None
     for eng in ("netcdf4", "h5netcdf"):
         try:
-            return xr.open_dataset(path, engine=eng)
+            return xr.open_dataset(path, engine=eng, chunks=NC_CHUNKS, decode_cf=True)
         except Exception as e:
             last_err = e
             print(f"[DEBUG] xarray engine '{eng}' failed: {e}")
     _log_head(path)
     raise ValueError(f"Could not open NetCDF: {last_err}")
 
+@lru_cache(maxsize=None)
+def _nearest_idx(lat_tuple, lon_tuple, lat, lon):
+    # every monthly file shares the AREA grid, so this is computed once per run
+    lat_vals = np.asarray(lat_tuple)
+    lon_vals = np.asarray(lon_tuple)
+    lon360 = lon % 360
+    lon_idx = int(np.nanargmin(np.minimum(np.abs(lon_vals - lon), np.abs(lon_vals - lon360))))
+    lat_idx = int(np.nanargmin(np.abs(lat_vals - lat)))
+    return lat_idx, lon_idx
+
 def _select_nearest_point(ds, lat, lon):
     lat_name = "latitude" if "latitude" in ds.coords else ("lat" if "lat" in ds.coords else None)
     lon_name = "longitude" if "longitude" in ds.coords else ("lon" if "lon" in ds.coords else None)
     if lat_name is None or lon_name is None:
         raise ValueError(f"Dataset missing lat/lon coords. Found coords: {list(ds.coords)}")
-    lat_vals = ds[lat_name].values
-    lon_vals = ds[lon_name].values
-    lon360 = lon % 360
-    lon_idx = int(np.nanargmin(np.minimum(np.abs(lon_vals - lon), np.abs(lon_vals - lon360))))
-    lat_idx = int(np.nanargmin(np.abs(lat_vals - lat)))
+    lat_idx, lon_idx = _nearest_idx(tuple(ds[lat_name].values.tolist()),
+                                    tuple(ds[lon_name].values.tolist()), lat, lon)
     ds_point = ds.isel({lat_name: lat_idx, lon_name: lon_idx})
     if "expver" in ds_point.dims:
         ds_point = ds_point.mean("expver")
-    return ds_point
-
-def _rename_columns(df):
-    mapping = {
-        "2m_temperature": "temperature",
-        "2m_dewpoint_temperature": "dewpoint",
-        "surface_pressure": "pressure",
-        "10m_u_component_of_wind": "u_wind",
-        "10m_v_component_of_wind": "v_wind",
-        "total_precipitation": "precipitation",
-        "surface_solar_radiation_downwards": "radiation",
-       
-        "t2m": "temperature",
-        "d2m": "dewpoint",
-        "sp": "pressure",
-        "u10": "u_wind",
-        "v10": "v_wind",
-        "tp": "precipitation",
-        "ssrd": "radiation",
-    }
-    return df.rename(columns={k: v for k, v in mapping.items() if k in df.columns})
+    # only the single grid point is read from disk
+    return ds_point.load()
 
 def _find_time_col(cols):
     for c in cols:
@@ -122,40 +175,41 @@ def _find_time_col(cols):
 def _process_downloaded_nc(nc_path) -> pd.DataFrame:
     ds = _open_any_netcdf(nc_path)
     ds_point = _select_nearest_point(ds, LAT, LON)
+    ds_point = ds_point.rename({k: v for k, v in VAR_RENAME.items() if k in ds_point.data_vars})
 
-    df = ds_point.to_dataframe().reset_index()
-    df = _rename_columns(df)
-
-    time_col = _find_time_col(df.columns)
+    time_col = _find_time_col(ds_point.dims)
     if time_col is None:
-        raise ValueError(f"No time coordinate found in dataset columns: {df.columns.tolist()}")
+        raise ValueError(f"No time dimension found in dataset dims: {list(ds_point.dims)}")
     if time_col != "time":
-        df = df.rename(columns={time_col: "time"})
-
-    if {"u_wind", "v_wind"}.issubset(df.columns):
-        df["wind_speed"] = np.sqrt(df["u_wind"] ** 2 + df["v_wind"] ** 2)
-
-    desired = ["time", "temperature", "dewpoint", "pressure", "wind_speed",
-               "precipitation", "radiation"]
-    keep = [c for c in desired if c in df.columns]
-    df = df[keep]
-
-    df["date"] = pd.to_datetime(df["time"]).dt.normalize()
-    agg = {k: DAILY_AGG[k] for k in DAILY_AGG if k in df.columns}
-    df_daily = df.groupby("date").agg(agg).reset_index()
-
-    if "temperature" in df_daily.columns:
-        df_daily["temperature"] = df_daily["temperature"] - 273.15  
-    if "dewpoint" in df_daily.columns:
-        df_daily["dewpoint"] = df_daily["dewpoint"] - 273.15        
-    if "pressure" in df_daily.columns:
-        df_daily["pressure"] = df_daily["pressure"] / 1000.0        
-    if "precipitation" in df_daily.columns:
-        df_daily["precipitation"] = df_daily["precipitation"] * 1000.0  
-    if "radiation" in df_daily.columns:
-        df_daily["radiation"] = df_daily["radiation"] / 1e6             
-
-    df_daily["source"] = "era5"
+        ds_point = ds_point.rename({time_col: "time"})
+    ds_point = ds_point.reset_coords(drop=True)
+
+    # wind speed is derived per hour, before averaging, so it stays a mean of speeds
+    if "u_wind" in ds_point and "v_wind" in ds_point:
+        ds_point["wind_speed"] = np.sqrt(ds_point["u_wind"] ** 2 + ds_point["v_wind"] ** 2)
+
+    # aggregate to daily in xarray so only the daily result is turned into a DataFrame
+    mean_vars = [k for k, how in DAILY_AGG.items() if how == "mean" and k in ds_point]
+    sum_vars = [k for k, how in DAILY_AGG.items() if how == "sum" and k in ds_point]
+    # a download can lack either group (e.g. only one stepType file in the
+    # archive); an empty selection has no time axis to resample
+    parts = [ds_point[vars_].resample(time="1D").mean() if how == "mean"
+             else ds_point[vars_].resample(time="1D").sum()
+             for vars_, how in ((mean_vars, "mean"), (sum_vars, "sum")) if vars_]
+    if not parts:
+        return pd.DataFrame(columns=["date", *DAILY_AGG, "source"])
+    ds_daily = xr.merge(parts)
+
+    df_daily = ds_daily.to_dataframe().reset_index().rename(columns={"time": "date"})
+    keep = ["date"] + [c for c in DAILY_AGG if c in df_daily.columns]
+    df_daily = df_daily[keep]
+
+    mask = np.array([c in df_daily.columns for c in UNIT_COLS])
+    cols = [c for c, present in zip(UNIT_COLS, mask) if present]
+    df_daily[cols] = df_daily[cols].to_numpy() * UNIT_SCALE[mask] + UNIT_OFFSET[mask]
+
+    # categorical, so Parquet stores it dictionary-encoded rather than per row
+    df_daily["source"] = pd.Categorical(["era5"] * len(df_daily), categories=["era5"])
     return df_daily
 
 def _retrieve_month_piece(year: int, month: int, days: list, target_path: str):
@@ -171,9 +225,29 @@ def _retrieve_month_piece(year: int, month: int, days: list, target_path: str):
     }
     c.retrieve("reanalysis-era5-single-levels", payload, target_path)
 
+def _fetch_month(yy: int, mm: int, day_list: list, tmpdir: str) -> Optional[pd.DataFrame]:
+    print(f"Fetching ERA5 {yy}-{mm:02d} ({len(day_list)} days)…")
+    target_nc = os.path.join(tmpdir, f"era5_{yy}{mm:02d}.nc")
+    try:
+        _retrieve_month_piece(yy, mm, day_list, target_nc)
+        size = os.path.getsize(target_nc) if os.path.exists(target_nc) else 0
+        print(f"  → downloaded {size/1e6:.2f} MB to {target_nc}")
+        if size < 10_000:
+            _log_head(target_nc)
+            print(f"   Skipping {yy}-{mm:02d}: file too small to be NetCDF.")
+            return None
+        df_month = _process_downloaded_nc(target_nc)
+        if df_month.empty:
+            print(f"   No data rows parsed for {yy}-{mm:02d}.")
+            return None
+        return df_month
+    except Exception as e:
+        print(f"  {yy}-{mm:02d}: {e}")
+        return None
+
 def fetch_range(start_str: str, end_str: str) -> pd.DataFrame:
-    start_dt = pd.to_datetime(start_str)
-    end_dt = pd.to_datetime(end_str)
+    start_dt = pd.to_datetime(start_str, format="ISO8601")
+    end_dt = pd.to_datetime(end_str, format="ISO8601")
     all_frames = []
 
     rng = pd.date_range(start_dt, end_dt, freq="D")
@@ -183,25 +257,17 @@ def fetch_range(start_str: str, end_str: str) -> pd.DataFrame:
 
     tmpdir = tempfile.mkdtemp(prefix="era5_dl_")
     try:
-        for (yy, mm), day_list in sorted(by_ym.items()):
-            print(f"Fetching ERA5 {yy}-{mm:02d} ({len(day_list)} days)…")
-            target_nc = os.path.join(tmpdir, f"era5_{yy}{mm:02d}.nc")
-            try:
-                _retrieve_month_piece(yy, mm, day_list, target_nc)
-                size = os.path.getsize(target_nc) if os.path.exists(target_nc) else 0
-                print(f"  → downloaded {size/1e6:.2f} MB to {target_nc}")
-                if size < 10_000:
-                    _log_head(target_nc)
-                    print(f"   Skipping {yy}-{mm:02d}: file too small to be NetCDF.")
-                    continue
-                df_month = _process_downloaded_nc(target_nc)
-                if not df_month.empty:
+        # overlap the CDS queue time of several months
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_CDS_WORKERS, len(by_ym)))) as pool:
+            # each task runs in a copy of the caller's context, so output
+            # captured by update_all still reaches this script's buffer
+            futures = [pool.submit(contextvars.copy_context().run,
+                                   _fetch_month, yy, mm, day_list, tmpdir)
+                       for (yy, mm), day_list in sorted(by_ym.items())]
+            for future in as_completed(futures):
+                df_month = future.result()
+                if df_month is not None:
                     all_frames.append(df_month)
-                else:
-                    print(f"   No data rows parsed for {yy}-{mm:02d}.")
-            except Exception as e:
-                print(f"  {yy}-{mm:02d}: {e}")
-                continue
     finally:
         shutil.rmtree(tmpdir, ignore_errors=True)
 
@@ -210,24 +276,29 @@ def fetch_range(start_str: str, end_str: str) -> pd.DataFrame:
                                      "wind_speed", "precipitation", "radiation", "source"])
     out = pd.concat(all_frames, ignore_index=True)
     out.drop_duplicates(subset=["date"], inplace=True)
+    out.sort_values("date", inplace=True)
     return out
 
+def compact():
+    rows = storage.compact(PARQUET_DIR, "date", VALUE_COLS)
+    if rows is None:
+        print("No ERA5 data to compact.")
+    else:
+        print(f"  Compacted {PARQUET_DIR} to {rows} rows.")
+
 # ============== MAIN ==============
 def main():
-    os.makedirs(os.path.dirname(CSV_FILE), exist_ok=True)
+    os.makedirs(os.path.dirname(PARQUET_DIR), exist_ok=True)
 
     today = pd.to_datetime(date.today())
     end_date = today - pd.Timedelta(days=5)   
-    start_date = pd.to_datetime("2024-01-01")
-
-    if os.path.exists(CSV_FILE):
-        df_old = pd.read_csv(CSV_FILE, parse_dates=["date"])
-        if not df_old.empty:
-            df_old["date"] = pd.to_datetime(df_old["date"])
-            last_date = df_old["date"].max()
-            start_date = last_date + pd.Timedelta(days=1)
-    else:
-        df_old = pd.DataFrame()
+    start_date = pd.to_datetime("2024-01-01", format="ISO8601")
+
+    if storage.migrate_csv(LEGACY_CSV_FILE, PARQUET_DIR, "date", VALUE_COLS):
+        print(f"  Imported {LEGACY_CSV_FILE} into {PARQUET_DIR} (CSV left in place).")
+    last_date = storage.read_last_date(PARQUET_DIR, "date")
+    if last_date is not None:
+        start_date = last_date + pd.Timedelta(days=1)
 
     if start_date > end_date:
         print("Nothing new to fetch for ERA5.")
@@ -239,17 +310,19 @@ def main():
         print(" No new ERA5 data parsed.")
         return
 
-    df_new["date"] = pd.to_datetime(df_new["date"])
+    # drop days that are already stored (e.g. after an interrupted run) instead
+    # of concatenating with the history and de-duplicating the whole table
+    last_new = df_new["date"].max()
+    stored = storage.stored_dates(PARQUET_DIR, "date", df_new["date"].dt.year.unique().tolist())
+    df_new = df_new[~df_new["date"].isin(stored)]
 
-    if df_old.empty:
-        df_all = df_new.copy()
-    else:
-        df_all = pd.concat([df_old, df_new], ignore_index=True)
-        df_all.drop_duplicates(subset=["date"], keep="last", inplace=True)
-
-    df_all = df_all.sort_values("date")
-    df_all.to_csv(CSV_FILE, index=False)
-    print(f"  Updated {CSV_FILE} with {len(df_new)} new rows.")
+    if not df_new.empty:
+        storage.write_parquet(df_new, PARQUET_DIR, "date", VALUE_COLS)
+    storage.write_last_date(PARQUET_DIR, last_new)
+    print(f"  Updated {PARQUET_DIR} with {len(df_new)} new rows.")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["--compact"]:
+        compact()
+    else:
+        main()
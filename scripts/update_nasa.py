@@ -1,10 +1,18 @@
 # update_nasa.py
-import requests
+import asyncio
+import aiohttp
+import orjson
 import pandas as pd
 from datetime import date, timedelta
 import os
+import sys
 
-CSV_FILE = "data/nasa_power_data.csv"
+import storage
+
+# year-partitioned Parquet dataset; each run appends its new rows
+PARQUET_DIR = "data/nasa_power_data.parquet"
+# pre-Parquet history, imported once on the first run after upgrading
+LEGACY_CSV_FILE = "data/nasa_power_data.csv"
 
 LAT, LON = 38.57, -7.91  # Palmela, PT
 
@@ -18,7 +26,18 @@ PARAMS = [
     "ALLSKY_SFC_SW_DWN" # Surface solar radiation (W/m²)
 ]
 
-def fetch_data(start, end):
+RENAME = {
+    "T2M": "temperature",
+    "RH2M": "humidity",
+    "WS2M": "wind_speed",
+    "WD2M": "wind_direction",
+    "PRECTOTCORR": "precipitation",
+    "ALLSKY_SFC_SW_DWN": "radiation",
+}
+# columns stored in the dataset besides datetime and source
+VALUE_COLS = list(RENAME.values())
+
+async def fetch_data(session, start, end):
     url = (
         "https://power.larc.nasa.gov/api/temporal/daily/point"
         f"?parameters={','.join(PARAMS)}"
@@ -27,67 +46,105 @@ def fetch_data(start, end):
         f"&start={start}&end={end}&format=JSON"
     )
     print(f"Fetching NASA POWER {start} → {end}")
-    r = requests.get(url, timeout=60)
-    r.raise_for_status()
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=60)) as r:
+        r.raise_for_status()
+        body = await r.read()
 
-    data = r.json()["properties"]["parameter"]
-    df = pd.DataFrame({k: v for k, v in data.items()})
-    df.index = pd.to_datetime(df.index, format="%Y%m%d")
+    data = orjson.loads(body)["properties"]["parameter"]
+    df = pd.DataFrame(data)
+    df.index = pd.to_datetime(df.index, format="%Y%m%d", cache=True)
     df.reset_index(inplace=True)
     df.rename(columns={"index": "datetime"}, inplace=True)
     return df
 
+def six_month_chunks(cur, end):
+    chunks = []
+    while cur <= end:
+        chunk_end = min(cur + pd.DateOffset(months=6) - pd.Timedelta(days=1), end)
+        chunks.append((cur, chunk_end))
+        cur = chunk_end + timedelta(days=1)
+    return chunks
+
+async def fetch_range(start, end):
+    # the point endpoint accepts multi-year ranges, so try a single request
+    # first and only split into 6-month chunks if the server refuses it
+    async with aiohttp.ClientSession() as session:
+        try:
+            return [await fetch_data(session, start.strftime("%Y%m%d"), end.strftime("%Y%m%d"))]
+        except (aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status != 413:
+                raise
+            print(f"Full-range request failed ({e!r}), falling back to 6-month chunks")
+
+        chunks = six_month_chunks(start, end)
+        # chunks are independent requests, so they are all sent at once
+        tasks = [fetch_data(session, cur.strftime("%Y%m%d"), chunk_end.strftime("%Y%m%d"))
+                 for cur, chunk_end in chunks]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    frames = []
+    for (cur, chunk_end), result in zip(chunks, results):
+        if isinstance(result, Exception):
+            print(f"Skipping {cur.date()} to {chunk_end.date()} → {result}")
+        else:
+            frames.append(result)
+    return frames
+
+def compact():
+    rows = storage.compact(PARQUET_DIR, "datetime", VALUE_COLS)
+    if rows is None:
+        print("No NASA POWER data to compact.")
+    else:
+        print(f"✅ Compacted {PARQUET_DIR} to {rows} rows.")
+
 def main():
     today = date.today()
     end_date = (today - timedelta(days=5)).strftime("%Y%m%d")  # this avoids from the nasa lag
     start_date = "20240101"
 
-    if os.path.exists(CSV_FILE):
-        df_old = pd.read_csv(CSV_FILE, parse_dates=["datetime"])
-        last_date = df_old["datetime"].max().date()
+    if storage.migrate_csv(LEGACY_CSV_FILE, PARQUET_DIR, "datetime", VALUE_COLS):
+        print(f"✅ Imported {LEGACY_CSV_FILE} into {PARQUET_DIR} (CSV left in place).")
+    last_date = storage.read_last_date(PARQUET_DIR, "datetime")
+    if last_date is not None:
         start_date = (last_date + timedelta(days=1)).strftime("%Y%m%d")
-    else:
-        df_old = pd.DataFrame()
 
     if start_date > end_date:
         print("No new data available from NASA POWER.")
         return
 
-    # Fetch in 6-month chunks
-    all_new = []
-    cur = pd.to_datetime(start_date)
-    end = pd.to_datetime(end_date)
-
-    while cur <= end:
-        chunk_end = min(cur + pd.DateOffset(months=6) - pd.Timedelta(days=1), end)
-        try:
-            df_chunk = fetch_data(cur.strftime("%Y%m%d"), chunk_end.strftime("%Y%m%d"))
-            all_new.append(df_chunk)
-        except Exception as e:
-            print(f"Skipping {cur.date()} to {chunk_end.date()} → {e}")
-        cur = chunk_end + timedelta(days=1)
+    cur = pd.to_datetime(start_date, format="%Y%m%d")
+    end = pd.to_datetime(end_date, format="%Y%m%d")
+    try:
+        all_new = asyncio.run(fetch_range(cur, end))
+    except Exception as e:
+        print(f"Skipping {cur.date()} to {end.date()} → {e}")
+        all_new = []
 
     if all_new:
         df_new = pd.concat(all_new, ignore_index=True)
 
         # Rename columns
-        df_new = df_new.rename(columns={
-            "T2M": "temperature",
-            "RH2M": "humidity",
-            "WS2M": "wind_speed",
-            "WD2M": "wind_direction",
-            "PRECTOTCORR": "precipitation",
-            "ALLSKY_SFC_SW_DWN": "radiation",
-        })
-        df_new["source"] = "nasa_power"
-
-        df_all = pd.concat([df_old, df_new], ignore_index=True)
-        df_all.drop_duplicates(subset=["datetime"], keep="last", inplace=True)
-        os.makedirs(os.path.dirname(CSV_FILE), exist_ok=True)
-        df_all.to_csv(CSV_FILE, index=False)
-        print(f"✅ Updated {CSV_FILE} with {len(df_new)} new rows.")
+        df_new = df_new.rename(columns=RENAME)
+        # categorical, so Parquet stores it dictionary-encoded rather than per row
+        df_new["source"] = pd.Categorical(["nasa_power"] * len(df_new), categories=["nasa_power"])
+
+        # drop days that are already stored (e.g. after an interrupted run) instead
+        # of concatenating with the history and de-duplicating the whole table
+        last_new = df_new["datetime"].max()
+        stored = storage.stored_dates(PARQUET_DIR, "datetime",
+                                      df_new["datetime"].dt.year.unique().tolist())
+        df_new = df_new[~df_new["datetime"].isin(stored)]
+
+        os.makedirs(os.path.dirname(PARQUET_DIR), exist_ok=True)
+        if not df_new.empty:
+            storage.write_parquet(df_new, PARQUET_DIR, "datetime", VALUE_COLS)
+        storage.write_last_date(PARQUET_DIR, last_new)
+        print(f"✅ Updated {PARQUET_DIR} with {len(df_new)} new rows.")
     else:
         print("⚠️ No new NASA POWER data fetched.")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["--compact"]:
+        compact()
+    else:
+        main()
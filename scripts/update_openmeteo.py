@@ -1,14 +1,23 @@
-#This obtains/updates the csv file witht the data from the openmeteo source
+#This obtains/updates the parquet file witht the data from the openmeteo source
 
+import asyncio
+import aiohttp
 import requests
+import numpy as np
 import pandas as pd
 import os
 import sys
 from datetime import datetime, timedelta, date
 
+import storage
+
 LAT, LON = 38.5692, -8.9014
-OUTFILE = '/Users/chandadiwakar/Desktop/SmartProduce/data/open_meteo.csv'
+# year-partitioned Parquet dataset; each run appends its new rows
+OUTDIR = '/Users/chandadiwakar/Desktop/SmartProduce/data/open_meteo.parquet'
+# pre-Parquet history, imported once on the first run after upgrading
+LEGACY_CSV_FILE = '/Users/chandadiwakar/Desktop/SmartProduce/data/open_meteo.csv'
 CHUNK_DAYS = 30
+MAX_CONCURRENT_REQUESTS = 8  # be polite to the free archive API
 OPENMETEO_API = 'https://archive-api.open-meteo.com/v1/archive'
 NASA_POWER_DAILY = 'https://power.larc.nasa.gov/api/temporal/daily/point'
 
@@ -24,8 +33,10 @@ OPENMETEO_PARAMS = [
     'apparent_temperature',
     'soil_moisture_0_to_7cm',
 ]
+# columns stored in the dataset besides datetime
+VALUE_COLS = OPENMETEO_PARAMS + ['uv_index']
 
-def fetch_openmeteo_chunk(start_date, end_date):
+async def fetch_openmeteo_chunk(session, semaphore, start_date, end_date):
     params = {
         'latitude': LAT,
         'longitude': LON,
@@ -34,20 +45,29 @@ def fetch_openmeteo_chunk(start_date, end_date):
         'hourly': ','.join(OPENMETEO_PARAMS),
         'timezone': 'auto',
     }
-    print(f"[Open-Meteo] Requesting {start_date} to {end_date}")
-    r = requests.get(OPENMETEO_API, params=params, timeout=60)
-    r.raise_for_status()
-    data = r.json()
+    async with semaphore:
+        print(f"[Open-Meteo] Requesting {start_date} to {end_date}")
+        async with session.get(OPENMETEO_API, params=params,
+                               timeout=aiohttp.ClientTimeout(total=60)) as r:
+            r.raise_for_status()
+            data = await r.json()
     if 'hourly' not in data or 'time' not in data['hourly']:
         print(f"[Open-Meteo] No hourly data for {start_date} to {end_date}")
         return pd.DataFrame()
 
-    df = pd.DataFrame({'datetime': pd.to_datetime(data['hourly']['time'])})
+    df = pd.DataFrame({'datetime': pd.to_datetime(data['hourly']['time'], format='%Y-%m-%dT%H:%M', cache=True)})
     for param in OPENMETEO_PARAMS:
-        df[param] = data['hourly'].get(param, [None]*len(df))
+        df[param] = data['hourly'].get(param, [np.nan]*len(df))
 
     return df
 
+async def fetch_openmeteo_chunks(start_date, end_date):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession() as session:
+        tasks = [fetch_openmeteo_chunk(session, semaphore, chunk_start, chunk_end)
+                 for chunk_start, chunk_end in chunk_dates(start_date, end_date)]
+        return await asyncio.gather(*tasks)
+
 def fetch_nasa_uv_daily(start_date, end_date):
 
     params = {
@@ -65,12 +85,10 @@ def fetch_nasa_uv_daily(start_date, end_date):
     data = r.json()
     try:
         uv_data = data['properties']['parameter']['ALLSKY_SFC_UV_INDEX']
-    
-        rows = []
-        for k, v in uv_data.items():
-            dt = datetime.strptime(k, '%Y%m%d').date()
-            rows.append({'date': dt, 'uv_index': v})
-        return pd.DataFrame(rows)
+        return pd.DataFrame({
+            'date': pd.to_datetime(list(uv_data.keys()), format='%Y%m%d', cache=True),
+            'uv_index': list(uv_data.values()),
+        })
     except Exception:
         print("[NASA POWER] UV data missing or invalid")
         return pd.DataFrame()
@@ -82,12 +100,12 @@ def add_uv_to_df(df, start_date, end_date):
 
     uv_df = fetch_nasa_uv_daily(start_date, end_date)
     if uv_df.empty:
-        df['uv_index'] = None
+        df['uv_index'] = np.nan
         return df
 
-    df['date'] = df['datetime'].dt.date
-    uv_map = uv_df.set_index('date')['uv_index'].to_dict()
-    df['uv_index'] = df['date'].map(uv_map)
+    # join on a datetime64 day key so the lookup stays vectorised
+    df['date'] = df['datetime'].dt.normalize()
+    df = df.drop(columns=['uv_index'], errors='ignore').merge(uv_df, on='date', how='left')
     df.drop(columns=['date'], inplace=True)
     return df
 
@@ -100,32 +118,43 @@ def chunk_dates(start_date, end_date, chunk_days=CHUNK_DAYS):
         yield current.isoformat(), chunk_end.isoformat()
         current = chunk_end + timedelta(days=1)
 
-def save_incremental(df):
-    os.makedirs(os.path.dirname(OUTFILE), exist_ok=True)
-    if os.path.exists(OUTFILE):
-        old = pd.read_csv(OUTFILE, parse_dates=['datetime'])
-        combined = pd.concat([old, df], ignore_index=True)
-        combined.drop_duplicates(subset=['datetime'], inplace=True)
-        combined.sort_values('datetime', inplace=True)
-        combined.to_csv(OUTFILE, index=False)
-        print(f"[Open-Meteo] Appended data, total rows: {len(combined)}")
+def save_incremental(df, last_date):
+    # append only; overlapping rows from manual backfills are dropped by compact()
+    os.makedirs(os.path.dirname(OUTDIR), exist_ok=True)
+    storage.write_parquet(df, OUTDIR, 'datetime', VALUE_COLS)
+    new_last = df['datetime'].max()
+    if last_date is None or new_last > last_date:
+        storage.write_last_date(OUTDIR, new_last)
+    print(f"[Open-Meteo] Appended {len(df)} rows")
+
+def compact():
+    rows = storage.compact(OUTDIR, 'datetime', VALUE_COLS, keep='first')
+    if rows is None:
+        print("[Open-Meteo] No data to compact.")
     else:
-        df.to_csv(OUTFILE, index=False)
-        print(f"[Open-Meteo] Saved new file with {len(df)} rows")
+        print(f"[Open-Meteo] Compacted data, total rows: {rows}")
 
 def main(start_date=None, end_date=None):
+    # read once here: without the marker file this scans the stored datetime column
+    if storage.migrate_csv(LEGACY_CSV_FILE, OUTDIR, 'datetime', VALUE_COLS):
+        print(f"[Open-Meteo] Imported {LEGACY_CSV_FILE} into {OUTDIR} (CSV left in place)")
+    last_date = storage.read_last_date(OUTDIR, 'datetime')
     if not start_date:
-        start_date = '2024-01-01'
+        if last_date is not None:
+            start_date = (last_date.date() + timedelta(days=1)).isoformat()
+        else:
+            start_date = '2024-01-01'
     if not end_date:
         end_date = (date.today() - timedelta(days=1)).isoformat()
 
+    if start_date > end_date:
+        print("[Open-Meteo] Nothing new to fetch.")
+        return
+
     print(f"[Open-Meteo] Updating from {start_date} to {end_date}")
 
-    all_chunks = []
-    for chunk_start, chunk_end in chunk_dates(start_date, end_date):
-        chunk_df = fetch_openmeteo_chunk(chunk_start, chunk_end)
-        if not chunk_df.empty:
-            all_chunks.append(chunk_df)
+    chunk_dfs = asyncio.run(fetch_openmeteo_chunks(start_date, end_date))
+    all_chunks = [chunk_df for chunk_df in chunk_dfs if not chunk_df.empty]
 
     if not all_chunks:
         print("[Open-Meteo] No data fetched.")
@@ -135,8 +164,11 @@ def main(start_date=None, end_date=None):
     df = add_uv_to_df(df, start_date, end_date)
     df.sort_values('datetime', inplace=True)
 
-    save_incremental(df)
+    save_incremental(df, last_date)
 
 if __name__ == '__main__':
     args = sys.argv[1:]
-    main(*args)
+    if args == ['--compact']:
+        compact()
+    else:
+        main(*args)
@@ -0,0 +1,126 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+import storage
+
+VALUE_COLS = ["temperature", "uv_index"]
+
+
+def _batch(day, temperature, uv_index):
+    return pd.DataFrame({
+        "datetime": pd.to_datetime([day]),
+        "temperature": [temperature],
+        "uv_index": [uv_index],
+    })
+
+
+def test_all_null_batch_reads_back_with_float_batches(tmp_path):
+    path = str(tmp_path / "data.parquet")
+    # the all-None batch is written first, so it would set the dataset schema to null
+    storage.write_parquet(_batch("2025-02-01", None, None), path, "datetime", VALUE_COLS)
+    storage.write_parquet(_batch("2025-01-01", 12.5, 3.0), path, "datetime", VALUE_COLS)
+
+    df = storage.read_dataset(path).sort_values("datetime").reset_index(drop=True)
+
+    assert len(df) == 2
+    assert df["temperature"].dtype == np.float64
+    assert df["uv_index"].dtype == np.float64
+    assert df.loc[0, "uv_index"] == 3.0
+    assert np.isnan(df.loc[1, "uv_index"])
+
+
+def test_missing_value_column_is_stored_as_float(tmp_path):
+    path = str(tmp_path / "data.parquet")
+    storage.write_parquet(_batch("2025-01-01", 12.5, 3.0).drop(columns=["uv_index"]),
+                          path, "datetime", VALUE_COLS)
+    storage.write_parquet(_batch("2025-01-02", 13.0, 4.0), path, "datetime", VALUE_COLS)
+
+    df = storage.read_dataset(path)
+
+    assert df["uv_index"].dtype == np.float64
+    assert df["uv_index"].notna().sum() == 1
+
+
+def test_compact_deduplicates_and_updates_marker(tmp_path):
+    path = str(tmp_path / "data.parquet")
+    storage.write_parquet(_batch("2025-01-02", None, None), path, "datetime", VALUE_COLS)
+    storage.write_parquet(_batch("2025-01-01", 12.5, 3.0), path, "datetime", VALUE_COLS)
+    storage.write_parquet(_batch("2025-01-01", 12.5, 3.0), path, "datetime", VALUE_COLS)
+
+    rows = storage.compact(path, "datetime", VALUE_COLS)
+
+    assert rows == 2
+    df = storage.read_dataset(path)
+    assert df["datetime"].is_monotonic_increasing
+    assert storage.read_last_date(path, "datetime") == pd.Timestamp("2025-01-02")
+
+
+def test_migrate_csv_imports_legacy_history_once(tmp_path):
+    csv_path = str(tmp_path / "data.csv")
+    path = str(tmp_path / "data.parquet")
+    pd.DataFrame({
+        "datetime": ["2024-01-01", "2024-01-02", "2024-01-02"],
+        "temperature": [10.0, 11.0, 11.5],
+        "uv_index": [None, None, None],
+        "source": ["nasa_power"] * 3,
+    }).to_csv(csv_path, index=False)
+
+    assert storage.migrate_csv(csv_path, path, "datetime", VALUE_COLS)
+    assert not storage.migrate_csv(csv_path, path, "datetime", VALUE_COLS)
+
+    df = storage.read_dataset(path)
+    assert len(df) == 2
+    assert df["uv_index"].dtype == np.float64
+    assert storage.read_last_date(path, "datetime") == pd.Timestamp("2024-01-02")
+
+
+def test_compact_resolves_duplicates_by_write_order(tmp_path):
+    path = str(tmp_path / "data.parquet")
+    for value in range(1, 7):
+        storage.write_parquet(_batch("2025-01-01", float(value), None), path, "datetime", VALUE_COLS)
+
+    assert storage.read_dataset(path)["temperature"].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+    storage.compact(path, "datetime", VALUE_COLS, keep="first")
+    storage.write_parquet(_batch("2025-01-01", 7.0, None), path, "datetime", VALUE_COLS)
+    storage.compact(path, "datetime", VALUE_COLS, keep="last")
+
+    assert storage.read_dataset(path)["temperature"].tolist() == [7.0]
+
+
+def _two_day_dataset(path):
+    storage.write_parquet(_batch("2025-01-01", 12.5, 3.0), path, "datetime", VALUE_COLS)
+    storage.write_parquet(_batch("2025-01-02", 13.0, 4.0), path, "datetime", VALUE_COLS)
+    storage.write_last_date(path, pd.Timestamp("2025-01-02"))
+
+
+def test_recover_restores_history_after_kill_between_renames(tmp_path):
+    path = str(tmp_path / "data.parquet")
+    _two_day_dataset(path)
+    # state after os.rename(path, path + ".old") with a half-written .tmp
+    os.rename(path, path + ".old")
+    os.makedirs(path + ".tmp")
+
+    assert storage.read_last_date(path, "datetime") == pd.Timestamp("2025-01-02")
+    assert len(storage.read_dataset(path)) == 2
+    assert storage.compact(path, "datetime", VALUE_COLS) == 2
+    assert not os.path.exists(path + ".old")
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_recover_drops_leftover_old_copy_after_swap(tmp_path):
+    path = str(tmp_path / "data.parquet")
+    _two_day_dataset(path)
+    storage.compact(path, "datetime", VALUE_COLS)
+    # state after both renames, killed before the old copy was removed
+    os.makedirs(os.path.join(path + ".old", "year=2025"))
+
+    storage.recover(path)
+
+    assert not os.path.exists(path + ".old")
+    assert len(storage.read_dataset(path)) == 2